@@ -1,105 +1,468 @@
 import os
+import asyncio
+import atexit
 import base64
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import hashlib
 import io
-import json
+import logging
+import math
+import queue
+import tempfile
+import threading
 import fitz
+import httpx
 import openai
+import orjson
 import pandas as pd
 from PIL import Image
 import streamlit as st
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
 # === File Paths ===
-VERIFIED_INVOICES_FILE = 'verified_invoices.json'
+VERIFIED_INVOICES_FILE = 'verified_invoices.jsonl'
+VERIFIED_INVOICES_LOCK_FILE = 'verified_invoices.jsonl.lock'
+LEGACY_VERIFIED_INVOICES_FILE = 'verified_invoices.json'
 APPROVED_INVOICES_FILE = 'approved_invoices.json'
+LLM_CACHE_DIR = '.llm_cache'
+
+# === Extraction Settings ===
+EXTRACTION_MODEL = "gpt-4o-2024-08-06"
+# Bump whenever the prompt or the expected output format changes so cached responses are not reused
+EXTRACTION_PROMPT_VERSION = 3
+MAX_CONCURRENT_REQUESTS = 8
+PAGE_RENDER_DPI = 120
+PAGES_PER_REQUEST = 4
+# Keep the original 4000-token output budget per page; 4 pages stays under gpt-4o-2024-08-06's 16k cap
+MAX_TOKENS_PER_PAGE = 4000
+
+# === Verified Invoice Log Settings ===
+COMPACT_MIN_RECORDS = 200
+
+logger = logging.getLogger(__name__)
 
 # === Load Environment Variables ===
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 # === File I/O Helpers ===
-def save_verified_invoices(verified_invoices):
-    with open(VERIFIED_INVOICES_FILE, 'w') as f:
-        json.dump(verified_invoices, f, indent=4)
+# Verified invoices are an append-only JSON-lines log: one record per verified invoice and a
+# {"_deleted": [file, page]} tombstone per removal, replayed into the live set on load.
+_verified_log_lock = threading.Lock()
+
+@contextlib.contextmanager
+def verified_log_lock():
+    with _verified_log_lock, open(VERIFIED_INVOICES_LOCK_FILE, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _write_verified_log(invoices):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(VERIFIED_INVOICES_FILE)), suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        for invoice in invoices:
+            f.write(orjson.dumps(invoice, option=orjson.OPT_APPEND_NEWLINE))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, VERIFIED_INVOICES_FILE)
+
+def _import_legacy_verified_invoices():
+    # One-time import of the pre-log verified_invoices.json list so pending invoices survive the upgrade
+    if os.path.exists(VERIFIED_INVOICES_FILE) or not os.path.exists(LEGACY_VERIFIED_INVOICES_FILE):
+        return
+    with verified_log_lock():
+        if os.path.exists(VERIFIED_INVOICES_FILE) or not os.path.exists(LEGACY_VERIFIED_INVOICES_FILE):
+            return
+        with open(LEGACY_VERIFIED_INVOICES_FILE, 'rb') as f:
+            _write_verified_log(orjson.loads(f.read()))
+
+def _append_verified_records(records):
+    _import_legacy_verified_invoices()
+    with verified_log_lock():
+        with open(VERIFIED_INVOICES_FILE, 'a+b') as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")  # terminate a torn line left by an interrupted append
+            for record in records:
+                f.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+            f.flush()
+            os.fsync(f.fileno())
+
+def _replay_verified_log():
+    invoices = {}
+    record_count = 0
+    with open(VERIFIED_INVOICES_FILE, 'rb') as f:
+        # The last element is empty or a partial line from an append still in progress
+        lines = f.read().split(b"\n")[:-1]
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            logger.warning("Skipping undecodable line in %s: %r", VERIFIED_INVOICES_FILE, line[:200])
+            continue
+        record_count += 1
+        if "_deleted" in record:
+            invoices.pop(tuple(record["_deleted"]), None)
+        else:
+            invoices[(record["file"], record["page"])] = record
+    return invoices, record_count
+
+def add_verified_invoice(invoice):
+    _append_verified_records([invoice])
+
+def remove_verified_invoices(invoices):
+    _append_verified_records([{"_deleted": [invoice["file"], invoice["page"]]} for invoice in invoices])
+
+def compact_verified_invoices():
+    with verified_log_lock():
+        if not os.path.exists(VERIFIED_INVOICES_FILE):
+            return
+        invoices, _ = _replay_verified_log()
+        _write_verified_log(invoices.values())
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _load_verified_log(mtime_ns, size):
+    invoices, record_count = _replay_verified_log()
+    if record_count > max(COMPACT_MIN_RECORDS, 2 * len(invoices)):
+        threading.Thread(target=compact_verified_invoices, daemon=True).start()
+    return list(invoices.values())
 
 def load_verified_invoices():
-    if os.path.exists(VERIFIED_INVOICES_FILE):
-        with open(VERIFIED_INVOICES_FILE, 'r') as f:
-            return json.load(f)
-    return []
+    _import_legacy_verified_invoices()
+    # Cached per (mtime, size) so reruns only re-read the log after it actually changes
+    try:
+        stat = os.stat(VERIFIED_INVOICES_FILE)
+    except FileNotFoundError:
+        return []
+    return _load_verified_log(stat.st_mtime_ns, stat.st_size)
 
 def save_approved_invoices(approved_invoices):
-    with open(APPROVED_INVOICES_FILE, 'w') as f:
-        json.dump(approved_invoices, f, indent=4)
+    with open(APPROVED_INVOICES_FILE, 'wb') as f:
+        f.write(orjson.dumps(approved_invoices, option=orjson.OPT_INDENT_2))
 
 def load_approved_invoices():
     if os.path.exists(APPROVED_INVOICES_FILE):
-        with open(APPROVED_INVOICES_FILE, 'r') as f:
-            return json.load(f)
+        with open(APPROVED_INVOICES_FILE, 'rb') as f:
+            return orjson.loads(f.read())
     return []
 
+# === Response Cache ===
+def response_cache_key(image_bytes):
+    digest = hashlib.sha256(f"{EXTRACTION_MODEL}:v{EXTRACTION_PROMPT_VERSION}:".encode("utf-8"))
+    digest.update(image_bytes)
+    return digest.hexdigest()
+
+def _cache_path(key):
+    return os.path.join(LLM_CACHE_DIR, f"{key}.json")
+
+@functools.lru_cache(maxsize=256)
+def _read_cached_response(key):
+    with open(_cache_path(key), 'rb') as f:
+        return orjson.loads(f.read())
+
+def load_cached_response(key):
+    if os.path.exists(_cache_path(key)):
+        return _read_cached_response(key)
+    return None
+
+def save_cached_response(key, result):
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(orjson.dumps(result))
+    os.replace(tmp_path, _cache_path(key))
+
+# === Temp File Storage ===
+_temp_file_paths = []
+
+def save_temp_image(image_bytes):
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        f.write(image_bytes)
+    _temp_file_paths.append(f.name)
+    return f.name
+
+@atexit.register
+def _remove_temp_files():
+    for path in _temp_file_paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 # === Utility Functions ===
 def encode_image(image_bytes):
     return base64.b64encode(image_bytes).decode("utf-8")
 
 def compress_image(image, max_size_mb=4):
-    image = image.convert("RGB")
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    max_bytes = max_size_mb * 1024 * 1024
+    quality = 85
     img_byte_arr = io.BytesIO()
-    quality = 95
-    while True:
+    image.save(img_byte_arr, format="JPEG", quality=quality, optimize=False, progressive=False)
+    size = img_byte_arr.tell()
+    if size > max_bytes:
+        # Size falls off faster than linearly as quality drops, so scaling quality by the
+        # square root of the overshoot usually lands under the cap in one re-encode
+        quality = max(10, int(quality * math.sqrt(max_bytes / size)))
         img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format="JPEG", quality=quality)
-        if img_byte_arr.tell() <= max_size_mb * 1024 * 1024 or quality <= 10:
-            break
-        quality -= 5
+        image.save(img_byte_arr, format="JPEG", quality=quality, progressive=True)
+    if img_byte_arr.tell() > max_bytes and quality > 10:
+        # Still over: fall back to the quality-10 floor the old stepping loop bottomed out at
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format="JPEG", quality=10, progressive=True)
     return img_byte_arr.getvalue()
 
-def extract_text_from_image(image_bytes):
-    base64_image = encode_image(image_bytes)
+def render_page_image(page, dpi=PAGE_RENDER_DPI, max_size_mb=4):
+    # Invoices are text on white; a single gray channel is a third of the pixels to blit and encode
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    jpeg_bytes = pix.tobytes("jpeg", jpg_quality=75)
+    if len(jpeg_bytes) > max_size_mb * 1024 * 1024:
+        return compress_image(Image.open(io.BytesIO(jpeg_bytes)), max_size_mb)
+    return jpeg_bytes
+
+async def request_extraction(client, images, on_first_chunk=None):
+    """
+    Send one or more invoice pages in a single streamed request; returns one JSON object per page.
+    on_first_chunk() fires once when the model starts answering.
+    """
     system_prompt = """
 You are an expert in parsing financial documents and invoices. Your task is to extract structured information from invoices of varying formats...
 (Return structured JSON under the categories: InvoiceDetails, VendorDetails, CutomerDetails, LineItems, ChargesSummary, Notes.)
 """
-    user_prompt = """
-Extract all relevant information from the following invoice text...
+    user_prompt = f"""
+Extract all relevant information from the following {len(images)} invoice page(s)...
 (As structured JSON in the specified six categories. Return empty strings for missing fields.)
+Return a JSON object of the form {{"pages": [...]}} with exactly {len(images)} objects, one per page, in page order.
 """
+    image_parts = []
+    for page_num, image_bytes in enumerate(images, start=1):
+        image_parts.append({"type": "text", "text": f"Page {page_num} of batch:"})
+        image_parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(image_bytes)}"}})
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": [
-            {"type": "text", "text": user_prompt},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-        ]}
+        {"role": "user", "content": [{"type": "text", "text": user_prompt}] + image_parts}
     ]
+    stream = await client.chat.completions.create(
+        model=EXTRACTION_MODEL,
+        messages=messages,
+        max_tokens=MAX_TOKENS_PER_PAGE * len(images),
+        temperature=0,
+        response_format={"type": "json_object"},
+        stream=True
+    )
+    parts = []
+    finish_reason = None
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta.content:
+            if not parts and on_first_chunk:
+                on_first_chunk()
+            parts.append(choice.delta.content)
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    if finish_reason != "stop":
+        raise ValueError(f"Response ended early (finish_reason={finish_reason})")
+    payload = orjson.loads("".join(parts))
+    results = payload.get("pages") if isinstance(payload, dict) else None
+    if not isinstance(results, list) or len(results) != len(images) or not all(isinstance(r, dict) for r in results):
+        raise ValueError(f"Expected {len(images)} invoice objects under \"pages\"")
+    return results
+
+async def extract_text_from_images(client, images, on_first_chunk=None):
+    cache_keys = [response_cache_key(image_bytes) for image_bytes in images]
+    # Cache file I/O runs on the default executor so it never blocks the shared event loop
+    results = await asyncio.to_thread(lambda: [load_cached_response(key) for key in cache_keys])
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=messages,
-            max_tokens=4000,
-            temperature=0
-        )
-        content = response.choices[0].message.content.strip()
-        json_start = content.find("{")
-        json_end = content.rfind("}")
-        return json.loads(content[json_start:json_end + 1])
+        fresh = await request_extraction(client, [images[i] for i in missing], on_first_chunk)
+    except ValueError as e:
+        # Bad JSON, wrong shape or a truncated reply: retry page by page so one unreadable page
+        # doesn't fail the whole batch (orjson.JSONDecodeError is a ValueError)
+        if len(missing) == 1:
+            results[missing[0]] = {"error": str(e)}
+            return results
+        for i in missing:
+            results[i] = (await extract_text_from_images(client, [images[i]]))[0]
+        return results
     except Exception as e:
-        return {"error": str(e)}
-
-def flatten_json(d, parent_key='', sep=' > '):
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_json(v, new_key, sep=sep).items())
+        # API failures (auth, rate limits, timeouts) would only repeat per page, so fail the batch
+        for i in missing:
+            results[i] = {"error": str(e)}
+        return results
+    for i, result in zip(missing, fresh):
+        await asyncio.to_thread(save_cached_response, cache_keys[i], result)
+        results[i] = result
+    return results
+
+async def extract_pages(client, renderer, jobs, on_complete=None, on_receiving=None, max_workers=MAX_CONCURRENT_REQUESTS):
+    """
+    Render and extract every (entry, pdf_doc, page_index) job in batches of PAGES_PER_REQUEST,
+    overlapping page rendering with in-flight requests and keeping at most max_workers requests open.
+    Returns (entry, image_bytes, result) in completion order; on_complete(count, entry, image_bytes, result)
+    fires per page and on_receiving(entries) when a batch starts streaming back.
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+    loop = asyncio.get_running_loop()
+
+    def render(batch):
+        return [render_page_image(pdf_doc.load_page(page_index)) for _, pdf_doc, page_index in batch]
+
+    async def run(batch):
+        # One executor call per batch keeps renders in job order, so the first request goes out
+        # as soon as the first batch is rendered instead of after a round-robin over all batches
+        images = await loop.run_in_executor(renderer, render, batch)
+        entries = [entry for entry, _, _ in batch]
+        on_first_chunk = (lambda: on_receiving(entries)) if on_receiving else None
+        async with semaphore:
+            batch_results = await extract_text_from_images(client, images, on_first_chunk)
+        return [(entry, image_bytes, result) for (entry, _, _), image_bytes, result in zip(batch, images, batch_results)]
+
+    batches = [jobs[i:i + PAGES_PER_REQUEST] for i in range(0, len(jobs), PAGES_PER_REQUEST)]
+    results = []
+    tasks = [asyncio.ensure_future(run(batch)) for batch in batches]
+    try:
+        for task in asyncio.as_completed(tasks):
+            for page_result in await task:
+                results.append(page_result)
+                if on_complete:
+                    on_complete(len(results), *page_result)
+    finally:
+        # The loop outlives this run, so batches still in flight must not keep sending requests
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+# === Shared Resources ===
+# The OpenAI client's connection pool is bound to the event loop that first uses it, so the
+# client and one long-lived loop thread are shared across reruns instead of asyncio.run per click.
+@st.cache_resource
+def get_extraction_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_render_executor():
+    # MuPDF is not thread-safe, so every page in the process is rendered on this one worker thread;
+    # a cancelled run's last render can never overlap the next run on the same cached document
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+@st.cache_resource
+def get_openai_client():
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=16))
+    return openai.AsyncOpenAI(api_key=openai.api_key, http_client=http_client)
+
+def run_extraction(jobs, on_complete=None, on_receiving=None):
+    """
+    Run extract_pages on the shared loop and relay its callbacks to the calling (script) thread,
+    which is the only thread allowed to update Streamlit elements.
+    """
+    events = queue.Queue()
+
+    def relay(callback):
+        return (lambda *args: events.put((callback, args))) if callback else None
+
+    future = asyncio.run_coroutine_threadsafe(
+        extract_pages(get_openai_client(), get_render_executor(), jobs, relay(on_complete), relay(on_receiving)),
+        get_extraction_loop())
+    try:
+        while not (future.done() and events.empty()):
+            try:
+                callback, args = events.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            callback(*args)
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+def open_pdf(uploaded_file, chunk_size=1024 * 1024):
+    """
+    Spool the upload to a temp file and open it from disk so PyMuPDF loads pages on demand
+    instead of holding another in-memory copy. Documents are cached per session by content hash.
+    """
+    digest = hashlib.sha256()
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tf:
+        for chunk in iter(lambda: uploaded_file.read(chunk_size), b""):
+            digest.update(chunk)
+            tf.write(chunk)
+    key = digest.hexdigest()
+    if key in st.session_state.pdf_docs:
+        os.remove(tf.name)
+    else:
+        _temp_file_paths.append(tf.name)
+        st.session_state.pdf_docs[key] = fitz.open(tf.name)
+    return st.session_state.pdf_docs[key]
+
+def status_rows(data):
+    return [{"file": row["file"], "page": row["page"], "status": row["status"]} for row in data]
+
+def flatten_json(d, sep=' > '):
+    """
+    Yield (key, value) leaves of nested JSON in document order, e.g. "LineItems[0] > Amount".
+    Walks an explicit stack of (path, value, is_leaf) so no frames or lists are built per level.
+    """
+    stack = [((str(k),), v, False) for k, v in reversed(d.items())]
+    while stack:
+        path, v, is_leaf = stack.pop()
+        if is_leaf:
+            yield sep.join(path), v
+        elif isinstance(v, dict):
+            stack.extend((path + (str(k),), item, False) for k, item in reversed(v.items()))
         elif isinstance(v, list):
-            for idx, item in enumerate(v):
-                if isinstance(item, dict):
-                    items.extend(flatten_json(item, f"{new_key}[{idx}]", sep=sep).items())
-                else:
-                    items.append((f"{new_key}[{idx}]", item))
+            for idx in range(len(v) - 1, -1, -1):
+                item_path = path[:-1] + (f"{path[-1]}[{idx}]",)
+                stack.append((item_path, v[idx], not isinstance(v[idx], dict)))
         else:
-            items.append((new_key, v))
-    return dict(items)
+            yield sep.join(path), v
+
+def get_flat_fields(row):
+    if "_flat" not in row:
+        row["_flat"] = dict(flatten_json(row["json"]))
+    return row["_flat"]
+
+def to_csv_bytes(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+def cache_csv_exports(data):
+    all_rows = []
+    for row in data:
+        if not isinstance(row["json"], dict):
+            continue
+        flat = get_flat_fields(row)
+        if "_csv_bytes" not in row:
+            row["_csv_bytes"] = to_csv_bytes(["Field", "Value"], flat.items())
+        all_rows.extend((row["file"], row["page"], k, v) for k, v in flat.items())
+    st.session_state.all_csv_bytes = to_csv_bytes(["File", "Page", "Field", "Value"], all_rows) if all_rows else None
 
 # === UI Screens ===
 def render_main_page():
@@ -110,6 +473,10 @@ def render_main_page():
         st.session_state.extraction_complete = False
     if "selected_view_idx" not in st.session_state:
         st.session_state.selected_view_idx = None
+    if "all_csv_bytes" not in st.session_state:
+        st.session_state.all_csv_bytes = None
+    if "pdf_docs" not in st.session_state:
+        st.session_state.pdf_docs = {}
 
     uploaded_files = st.file_uploader("Upload PDF invoices", type=["pdf"], accept_multiple_files=True)
     if uploaded_files and st.button("Extract All"):
@@ -119,47 +486,53 @@ def render_main_page():
         existing_keys = {(d["file"], d["page"]) for d in st.session_state.data}
         st.session_state.extraction_complete = False
         st.session_state.selected_view_idx = None
-        total_pages = sum(fitz.open(stream=f.read(), filetype="pdf").page_count for f in uploaded_files)
+        docs = []
+        for uploaded_file in uploaded_files:
+            docs.append((uploaded_file.name, open_pdf(uploaded_file)))
+        total_pages = sum(pdf_doc.page_count for _, pdf_doc in docs)
         progress = st.progress(0, text="Starting...")
         status_area = st.empty()
-        count = 0
         with st.spinner("🔄 Extracting invoices..."):
-            for uploaded_file in uploaded_files:
-                filename = uploaded_file.name
-                uploaded_file.seek(0)
-                pdf_doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-                for page_num, page in enumerate(pdf_doc):
+            jobs = []
+            for filename, pdf_doc in docs:
+                for page_num in range(pdf_doc.page_count):
                     key = (filename, page_num + 1)
                     if key in existing_keys:
                         continue
                     entry = {"file": filename, "page": page_num + 1, "status": "Extracting...", "image": None, "json": None}
                     st.session_state.data.append(entry)
-                    status_area.table(pd.DataFrame(st.session_state.data)[["file", "page", "status"]])
-                    image_bytes = page.get_pixmap(dpi=150).pil_tobytes(format="jpeg")
-                    image_pil = Image.open(io.BytesIO(image_bytes))
-                    compressed = compress_image(image_pil)
-                    result = extract_text_from_image(compressed)
-                    entry["status"] = "Done" if "error" not in result else "Failed"
-                    entry["image"] = compressed
-                    entry["json"] = result
-                    status_area.table(pd.DataFrame(st.session_state.data)[["file", "page", "status"]])
-                    count += 1
-                    percent_complete = int((count / total_pages) * 100)
-                    progress.progress(count / total_pages, text=f"Processing... {percent_complete}% completed")
+                    jobs.append((entry, pdf_doc, page_num))
+            status_area.dataframe(status_rows(st.session_state.data), use_container_width=True)
+            render_every = max(1, len(jobs) // 20)
+
+            def on_complete(count, entry, image_bytes, result):
+                entry["image"] = save_temp_image(image_bytes)
+                entry["json"] = result
+                entry["status"] = "Done" if "error" not in result else "Failed"
+                if count % render_every == 0 or count == len(jobs):
+                    status_area.dataframe(status_rows(st.session_state.data), use_container_width=True)
+                percent_complete = int((count / total_pages) * 100)
+                progress.progress(count / total_pages, text=f"Processing... {percent_complete}% completed")
+
+            def on_receiving(entries):
+                # Shown on the next throttled table refresh in on_complete
+                for entry in entries:
+                    entry["status"] = "Receiving..."
+
+            try:
+                run_extraction(jobs, on_complete, on_receiving)
+            except BaseException:
+                # Drop pages that never finished so the next "Extract All" picks them up again
+                st.session_state.data = [row for row in st.session_state.data if row["status"] in ("Done", "Failed")]
+                raise
+        cache_csv_exports(st.session_state.data)
         st.session_state.extraction_complete = True
         st.rerun()
 
     if st.session_state.extraction_complete:
         st.subheader("✅ View Extracted Pages")
-        combined_rows = []
-        for row in st.session_state.data:
-            if isinstance(row["json"], dict):
-                flat = flatten_json(row["json"])
-                for k, v in flat.items():
-                    combined_rows.append({"File": row["file"], "Page": row["page"], "Field": k, "Value": v})
-        if combined_rows:
-            full_df = pd.DataFrame(combined_rows)
-            st.download_button("📥 Download All Extracted Data (CSV)", data=full_df.to_csv(index=False).encode("utf-8"),
+        if st.session_state.all_csv_bytes:
+            st.download_button("📥 Download All Extracted Data (CSV)", data=st.session_state.all_csv_bytes,
                                file_name="all_invoices_extracted.csv", mime="text/csv")
         for idx, row in enumerate(st.session_state.data):
             col1, col2, col3 = st.columns([3, 1, 1])
@@ -179,13 +552,11 @@ def render_main_page():
 
                 with view_col2:
                     if isinstance(row["json"], dict):
-                        flat = flatten_json(row["json"])
-                        df = pd.DataFrame(flat.items(), columns=["Field", "Value"])
+                        df = pd.DataFrame(get_flat_fields(row).items(), columns=["Field", "Value"])
                         st.dataframe(df, use_container_width=True)
-                        csv_bytes = df.to_csv(index=False).encode("utf-8")
                         st.download_button(
                             label="📥 Download CSV for This Page",
-                            data=csv_bytes,
+                            data=row["_csv_bytes"],
                             file_name=f"{row['file'].replace('.pdf','')}_page_{row['page']}.csv",
                             mime="text/csv"
                         )
@@ -221,21 +592,23 @@ def render_procurement_review():
             with col1:
                 st.image(row["image"], caption="Invoice Page", use_container_width=True)
 
-            verified_entry = {}
             with col2:
                 st.subheader("🔍 Verify Fields")
-                flat_data = flatten_json(row["json"])
-                for field, value in flat_data.items():
-                    new_val = st.text_input(f"{field}", value=value, key=f"{idx}_{field}")
-                    verified_entry[field] = new_val
+                flat_data = get_flat_fields(row)
+                fields_df = pd.DataFrame(
+                    [(field, "" if value is None else str(value)) for field, value in flat_data.items()],
+                    columns=["Field", "Value"]
+                )
+                edited_df = st.data_editor(fields_df, num_rows="fixed", disabled=["Field"], hide_index=True,
+                                           use_container_width=True, key=f"edit_{idx}")
 
                 if st.button("✅ Verify & Forward to Finance", key=f"verify_{idx}"):
-                    verified_invoices.append({
+                    verified_entry = dict(zip(edited_df["Field"], edited_df["Value"]))
+                    add_verified_invoice({
                         "file": row["file"],
                         "page": row["page"],
                         "fields": verified_entry
                     })
-                    save_verified_invoices(verified_invoices)
                     st.success("Verified and forwarded to Finance.")
                     st.rerun()
 
@@ -260,9 +633,8 @@ def render_finance_approval():
         return
 
     approved_invoices = load_approved_invoices()
-    updated_invoices = []
+    approved_now = []
     for idx, invoice in enumerate(verified_invoices):
-        approved = False
         with st.expander(f"{invoice['file']} – Page {invoice['page']}"):
             df = pd.DataFrame(invoice["fields"].items(), columns=["Field", "Value"])
             st.dataframe(df, use_container_width=True)
@@ -270,11 +642,9 @@ def render_finance_approval():
                 st.success("Invoice Approved ✅")
                 approved_invoices.append(invoice)
                 save_approved_invoices(approved_invoices)
-                approved = True
-        if not approved:
-            updated_invoices.append(invoice)
-    if len(updated_invoices) != len(verified_invoices):
-        save_verified_invoices(updated_invoices)
+                approved_now.append(invoice)
+    if approved_now:
+        remove_verified_invoices(approved_now)
         st.rerun()
 
 def run_invoice_extractor_app():
@@ -1,5 +1,6 @@
 import os
 import io
+import math
 import re
 import base64
 import streamlit as st
@@ -16,19 +17,30 @@ if not openai.api_key:
     st.error("OpenAI API key not found in .env file.")
     st.stop()
 
+# GPT-4o rescales vision inputs anyway, so larger images only add upload and base64 cost
+MAX_IMAGE_EDGE = 1536
+INVOICE_NUMBER_RE = re.compile(r"Best Vendor:.*?Invoice\s+(\d+)", re.IGNORECASE | re.DOTALL)
+
 
 def compress_image(image, max_size_mb=1):
     """
-    Compress image to JPEG under max_size_mb
+    Compress image to JPEG under max_size_mb with at most two re-encodes
+    (as before, quality 10 is the floor, so the cap is not guaranteed below it)
     """
-    img_byte_arr = io.BytesIO()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    max_bytes = max_size_mb * 1024 * 1024
     quality = 80
-    while True:
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format="JPEG", quality=quality, optimize=False, progressive=False)
+    size = img_byte_arr.tell()
+    if size > max_bytes:
+        quality = max(10, int(quality * math.sqrt(max_bytes / size)))
+        img_byte_arr = io.BytesIO()
+        image.save(img_byte_arr, format="JPEG", quality=quality, progressive=True)
+    if img_byte_arr.tell() > max_bytes and quality > 10:
         img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format="JPEG", quality=quality)
-        if img_byte_arr.tell() <= max_size_mb * 1024 * 1024 or quality <= 10:
-            break
-        quality -= 5
+        image.save(img_byte_arr, format="JPEG", quality=10, progressive=True)
     return img_byte_arr.getvalue()
 
 
@@ -40,7 +52,7 @@ def encode_image(image_bytes):
 
 
 def extract_invoice_number(text):
-    match = re.search(r"Best Vendor:.*?Invoice\s+(\d+)", text, re.IGNORECASE)
+    match = INVOICE_NUMBER_RE.search(text)
     return int(match.group(1)) if match else None
 
 
@@ -63,7 +75,8 @@ def main():
                 if file_ext == "pdf":
                     doc = fitz.open(stream=file_bytes, filetype="pdf")
                     page = doc[0]  # only use first page
-                    pix = page.get_pixmap(dpi=150)
+                    dpi = min(150, int(MAX_IMAGE_EDGE * 72 / max(page.rect.width, page.rect.height)))
+                    pix = page.get_pixmap(dpi=dpi)
                     img_bytes = pix.tobytes("jpeg")
                     base64_img = encode_image(img_bytes)
                     image_prompts.append({
@@ -74,6 +87,7 @@ def main():
 
                 else:
                     image = Image.open(io.BytesIO(file_bytes))
+                    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
                     compressed = compress_image(image)
                     base64_img = encode_image(compressed)
                     image_prompts.append({